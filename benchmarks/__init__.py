@@ -0,0 +1,3 @@
+"""Benchmarks for enumticket. Run ``python -m benchmarks.bench --help``
+from the repository root.
+"""
@@ -0,0 +1,166 @@
+"""Time PageLayout.generate for different ticket counts, orders and
+drawables and save the results as JSON, so that runs on different
+commits can be compared.
+
+Every case runs in a fresh worker process, so that the peak RSS that
+is reported belongs to that case only.
+
+Example::
+
+    python -m benchmarks.bench --counts 1000 10000 --output before.json
+    python -m benchmarks.bench --counts 1000 10000 --compare before.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import ticket
+from reportlab.lib.units import mm
+from reportlab.lib.pagesizes import A3
+from reportlab.pdfgen.canvas import Canvas
+
+
+IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                     "samples", "numbered_ticket_jazz_01.png")
+
+COUNTS = [1000, 10000, 100000]
+
+ORDERS = {
+    "stack": ticket.STACKORDER,
+    "sequential": ticket.SEQUENTIALORDER,
+    "random": ticket.RANDOMORDER,
+}
+
+DRAWABLES = {
+    "Image": lambda: ticket.Image(IMAGE),
+    "Box": lambda: ticket.Box(5*mm, 5*mm, 40*mm, 12*mm),
+    "Counter": lambda: ticket.Counter(22*mm, 5*mm, fontname='Courier-Bold', fontsize=14),
+    "VerticalCounter": lambda: ticket.VerticalCounter(60*mm, 20*mm, fontname='Courier-Bold', fontsize=14),
+    "Label": lambda: ticket.Label(22*mm, 20*mm, fontname='Times-BoldItalic', fontsize=12),
+    "QrCodeDrawable": lambda: ticket.QrCodeDrawable(20*mm, 40*mm, 25*mm, template="https://example.com/{0}"),
+}
+
+# Relative slowdown of tickets/sec at which compare reports a regression
+THRESHOLD = 0.1
+
+
+def run_case(count, order, cropmarks, drawable):
+    """
+    Generate one layout into a temporary file and measure it.
+    Runs in a worker process.
+    """
+    t = ticket.Ticket(68*mm, 97*mm)
+    t.add_drawable(DRAWABLES[drawable]())
+    labels = ["Name {0}".format(i) for i in range(0, count)] if drawable == "Label" else []
+    layout = ticket.PageLayout(t, count, pagesize=A3, bottom=10*mm, left=6*mm,
+                               top=10*mm, right=6*mm, labels=labels, seed=1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "bench.pdf")
+        start = time.perf_counter()
+        c = Canvas(filename, layout.pagesize, invariant=1)
+        layout.generate(c, order=ORDERS[order], cropmarks=cropmarks)
+        c.save()
+        seconds = time.perf_counter() - start
+        size = os.path.getsize(filename)
+    return {
+        "count": count,
+        "order": order,
+        "cropmarks": cropmarks,
+        "drawable": drawable,
+        "seconds": seconds,
+        "tickets_per_sec": count / seconds,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "output_bytes": size,
+    }
+
+
+def case_key(result):
+    return (result["count"], result["order"], result["cropmarks"], result["drawable"])
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(IMAGE)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(counts, orders, cropmarks, drawables):
+    results = []
+    for case in itertools.product(counts, orders, cropmarks, drawables):
+        # a new process per case keeps ru_maxrss meaningful
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_case, *case).result()
+        print("{count:>7} {order:<10} cropmarks={cropmarks!s:<5} {drawable:<16} "
+              "{tickets_per_sec:>10.0f} tickets/s {peak_rss_kb:>9} kB {output_bytes:>11} B".format(**result))
+        results.append(result)
+    return {
+        "commit": get_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """
+    Print the change in tickets/sec, peak RSS and output size of
+    every case found in both runs. Returns the number of cases whose
+    throughput dropped by more than threshold.
+    """
+    previous = dict((case_key(r), r) for r in old["results"])
+    regressions = 0
+    for result in new["results"]:
+        before = previous.get(case_key(result))
+        if before is None:
+            continue
+        speed = result["tickets_per_sec"] / before["tickets_per_sec"] - 1
+        flag = ""
+        if speed < -threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print("{0:>7} {1:<10} cropmarks={2!s:<5} {3:<16}".format(*case_key(result)),
+              "speed {0:+.1%} rss {1:+.1%} size {2:+.1%}{3}".format(
+                  speed,
+                  result["peak_rss_kb"] / before["peak_rss_kb"] - 1,
+                  result["output_bytes"] / before["output_bytes"] - 1,
+                  flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", type=int, nargs="+", default=COUNTS)
+    parser.add_argument("--orders", nargs="+", choices=list(ORDERS), default=list(ORDERS))
+    parser.add_argument("--drawables", nargs="+", choices=list(DRAWABLES), default=list(DRAWABLES))
+    parser.add_argument("--cropmarks", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="file the results are written to")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    cropmarks = {"on": [True], "off": [False], "both": [True, False]}[args.cropmarks]
+    data = run(args.counts, args.orders, cropmarks, args.drawables)
+    with open(args.output, "w") as f:
+        json.dump(data, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, data) > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,13 +3,27 @@ changing content on a sheet of paper and put changeable object
 on it such as counters, strings from a string list, etc.
 """
 
-from random import shuffle
+from random import Random, getrandbits
 from math import ceil
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor, Future
+import copy
+import hashlib
+import json
+import pickle
+import os
+import mmap
+import struct
+import tempfile
+import zipfile
+from time import perf_counter
 from reportlab.lib.units import mm
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.colors import black, white
 from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase import pdfdoc
+from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.utils import ImageReader
 import qrcode
 import io
@@ -26,16 +40,97 @@ ALIGNRIGHT = 4
 CLOCKWISE = 1
 COUNTERCLOCKWISE = 2
 
+NOROTATION = 1
+AUTOROTATION = 2
+MIXEDROTATION = 4
+
 LABEL = 1
 NUMBER = 2
 
 Margins = namedtuple('Margins', ['bottom', 'left', 'top', 'right'])
+Block = namedtuple('Block', ['left', 'top', 'cols', 'rows', 'width', 'height', 'rotated'])
+Placement = namedtuple('Placement', ['page', 'col', 'row', 'label', 'shard'])
+
+MASK64 = (1 << 64) - 1
+
+QRCODE_CACHE_SIZE = 4096
+
+IMAGE_CACHE_SIZE = 16
+
+DISK_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+
+class FontMetrics(object):
+    """
+    Metrics of a font at a given size. The width of every glyph
+    is looked up once and then kept, so that string widths are
+    computed by adding up the widths of the characters.
+    """
+    def __init__(self, fontname, fontsize):
+        self.fontname = fontname
+        self.fontsize = fontsize
+        self.font = pdfmetrics.getFont(fontname)
+        face = self.font.face
+        self.ascent = face.ascent / 1000 * fontsize
+        self.descent = face.descent / 1000 * fontsize
+        self.height = self.ascent - self.descent
+        self.widths = {}
+
+    def string_width(self, s):
+        widths = self.widths
+        width = 0
+        for c in s:
+            w = widths.get(c)
+            if w is None:
+                w = widths[c] = self.font.stringWidth(c, self.fontsize)
+            width += w
+        return width
+
+
+# FontMetrics instances by (fontname, fontsize)
+font_metrics = {}
+
 
+def get_font_metrics(fontname, fontsize):
+    try:
+        return font_metrics[(fontname, fontsize)]
+    except KeyError:
+        metrics = font_metrics[(fontname, fontsize)] = FontMetrics(fontname, fontsize)
+        return metrics
+
+
+def end_form(canvas):
+    """
+    Same as canvas.endForm, but the resources of the form also list
+    the shadings, transparency states and color spaces used in it,
+    which reportlab only sets up for pages. Artwork with gradients
+    or transparency needs them.
+    """
+    resources = pdfdoc.PDFResourceDictionary()
+    resources.basicFonts()
+    resources.allProcs()
+    if canvas._formsinuse:
+        resources.XObject = canvas._doc.xobjDict(canvas._formsinuse)
+    extgstate = canvas._extgstate.getState()
+    if extgstate:
+        resources.ExtGState = extgstate
+    resources.setShading(canvas._shadingUsed)
+    resources.setColorSpace(canvas._colorsUsed)
+    canvas.endForm(Resources=resources)
+
+
+def has_form(canvas, formname):
+    """
+    True if a form of that name is already defined in the
+    document of the canvas.
+    """
+    doc = canvas._doc
+    return doc.getXObjectName(formname) in doc.idToObject
 
 
 def get_font_height(fontname, fontsize):
-    face = pdfmetrics.getFont(fontname).face
-    return (face.ascent - face.descent) / 1000 * fontsize
+    return get_font_metrics(fontname, fontsize).height
     
 
 
@@ -45,13 +140,353 @@ def format_number(digits, number):
 
 
 
+def encode_qrcode(data, version, error_correction, border, box_size, fit):
+    """
+    Encode data as a QR code. Module level so that it can be run
+    in a worker process.
+    """
+    qr = qrcode.QRCode(version=version, box_size=box_size, error_correction=error_correction, border=border)
+    qr.add_data(data)
+    qr.make(fit=fit)
+    return qr
+
+
+
+class LruCache(object):
+    """
+    Least recently used cache for data that is expensive to prepare,
+    such as encoded QR codes or decoded images, shared within a
+    process. Values may be futures of work that is still running in
+    a worker pool, they are resolved when the value is looked up.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            return None
+        self.entries.move_to_end(key)
+        if isinstance(value, Future):
+            value = value.result()
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+qrcode_cache = LruCache(QRCODE_CACHE_SIZE)
+
+image_cache = LruCache(IMAGE_CACHE_SIZE)
+
+
+
+class DiskCache(object):
+    """
+    Content addressed cache directory for prepared artwork that
+    survives the process, e.g. compressed image streams. Entries are
+    keyed by a hash of the source file and the render parameters.
+    When the directory grows beyond maxsize bytes, the least recently
+    used entries are removed.
+
+    Data entries hold JSON metadata and raw bytes. Object entries are
+    pickled, so only a directory nobody else can write to must be
+    used. Entries that cannot be loaded, e.g. written by other
+    versions of the libraries, are removed and count as a miss.
+    """
+    def __init__(self, directory, maxsize=DISK_CACHE_SIZE):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, filename, params):
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        h.update(repr(params).encode("utf-8"))
+        return h.hexdigest()
+
+    def get_path(self, key, suffix=".pickle"):
+        return os.path.join(self.directory, key + suffix)
+
+    def load(self, path, func):
+        """
+        Read the entry at path with func. Returns None if there is no
+        such entry, a damaged or stale entry is removed as well.
+        """
+        try:
+            with open(path, "rb") as f:
+                value = func(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self.remove(path)
+            return None
+        # the modification time tells which entries were used last
+        os.utime(path)
+        return value
+
+    def store(self, path, func):
+        """
+        Write the entry at path with func, atomically.
+        """
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            func(f)
+        os.replace(tmpname, path)
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, key):
+        return self.load(self.get_path(key), pickle.load)
+
+    def put(self, key, value):
+        self.store(self.get_path(key),
+                   lambda f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def get_data(self, key):
+        """
+        Look up a data entry. Returns a tuple (meta, data) of the
+        JSON metadata and the bytes, or None.
+        """
+        def read(f):
+            meta = json.loads(f.readline().decode("utf-8"))
+            return meta, f.read()
+        return self.load(self.get_path(key, ".data"), read)
+
+    def put_data(self, key, meta, data):
+        """
+        Store JSON serialisable metadata and bytes as a data entry.
+        """
+        def write(f):
+            f.write(json.dumps(meta).encode("utf-8") + b"\n")
+            f.write(data)
+        self.store(self.get_path(key, ".data"), write)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((".pickle", ".data")):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        while total > self.maxsize and len(entries) > 0:
+            mtime, size, path = entries.pop(0)
+            self.remove(path)
+            total -= size
+
+
+# DiskCache used for prepared artwork, disabled if None
+disk_cache = None
+
+
+def set_disk_cache(directory, maxsize=DISK_CACHE_SIZE):
+    """
+    Keep prepared artwork in directory across runs. Pass None
+    as directory to disable the cache again.
+    """
+    global disk_cache
+    if directory is None:
+        disk_cache = None
+    else:
+        disk_cache = DiskCache(directory, maxsize)
+
+class Profiler(object):
+    """
+    Opt-in instrumentation of Ticket.paint and PageLayout.generate.
+    Pass an instance to PageLayout.generate to collect the time, the
+    number of calls and the bytes added to the content stream for
+    every drawable class and instance, the placement of static forms,
+    and per page totals for paint_cropmarks and showPage. Without a
+    profiler the drawing code only pays for one check per drawable.
+
+    Attributes
+    ----------
+    callback: callable
+        Called with the profiler when generate has finished,
+        e.g. to feed the numbers into a metrics system.
+
+    stats: dict
+        Maps (kind, name) to a list [seconds, calls, bytes].
+
+    pages: list of dicts
+        Timings of every page: cropmarks, tickets and showPage.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stats = {}
+        self.pages = []
+
+    def add(self, key, seconds, nbytes=0):
+        stat = self.stats.get(key)
+        if stat is None:
+            stat = self.stats[key] = [0.0, 0, 0]
+        stat[0] += seconds
+        stat[1] += 1
+        stat[2] += nbytes
+
+    def call(self, key, canvas, func, *args):
+        """
+        Call func with args and record the time it took and the
+        bytes it added to the content stream of the canvas.
+        Returns the time in seconds.
+        """
+        code = canvas._code
+        start = len(code)
+        t0 = perf_counter()
+        func(*args)
+        seconds = perf_counter() - t0
+        nbytes = 0
+        if canvas._code is code:
+            nbytes = sum(len(s) + 1 for s in code[start:])
+        self.add(key, seconds, nbytes)
+        return seconds
+
+    def draw(self, drawable, canvas, ticket):
+        self.record(drawable, canvas, ticket, drawable.draw, canvas, ticket)
+
+    def collect(self, drawable, batch, canvas, ticket):
+        """
+        Same as draw for a text drawable whose string is collected
+        into a TextBatch. The bytes are counted for the text batch.
+        """
+        self.record(drawable, canvas, ticket, drawable.collect, batch, canvas, ticket)
+
+    def record(self, drawable, canvas, ticket, func, *args):
+        """
+        Record a call of func for the class and the instance
+        of the drawable.
+        """
+        name = type(drawable).__name__
+        before = self.stats.get(("class", name), [0.0, 0, 0])[:]
+        self.call(("class", name), canvas, func, *args)
+        after = self.stats[("class", name)]
+        instance = "{0}[{1}]".format(name, ticket.drawables.index(drawable))
+        self.add(("drawable", instance), after[0] - before[0], after[2] - before[2])
+
+    def add_page(self, page, cropmarks, tickets, showpage):
+        self.pages.append({"page": page, "cropmarks": cropmarks,
+                           "tickets": tickets, "showPage": showpage})
+
+    def finish(self):
+        if self.callback is not None:
+            self.callback(self)
+
+    def report(self):
+        """
+        Text report of all records, slowest first.
+        """
+        lines = ["{0:<9} {1:<24} {2:>9} {3:>11} {4:>12} {5:>10}".format(
+            "kind", "name", "calls", "seconds", "bytes", "us/call")]
+        for (kind, name), (seconds, calls, nbytes) in sorted(
+                self.stats.items(), key=lambda item: item[1][0], reverse=True):
+            lines.append("{0:<9} {1:<24} {2:>9} {3:>11.4f} {4:>12} {5:>10.1f}".format(
+                kind, name, calls, seconds, nbytes, seconds / calls * 1e6))
+        return "\n".join(lines)
+
+
+# serial numbers for naming forms
+serials = count()
+
+
+
+class Permutation(object):
+    """
+    Seeded pseudo random bijection of range(size). A Feistel network
+    shuffles the values of the smallest power of four that covers
+    size, values outside the range are mapped again until they fall
+    inside it (cycle walking). Any value and its inverse can be
+    computed on its own without building a shuffled list.
+    """
+    rounds = 4
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        self.halfbits = max(1, (max(size - 1, 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.halfbits) - 1
+        rnd = Random(seed)
+        self.keys = [rnd.getrandbits(64) for i in range(0, self.rounds)]
+
+    def round_value(self, r, x):
+        z = (x + self.keys[r]) & MASK64
+        z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+        z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & MASK64
+        return (z ^ (z >> 31)) & self.mask
+
+    def encrypt(self, x):
+        left, right = x >> self.halfbits, x & self.mask
+        for r in range(0, self.rounds):
+            left, right = right, left ^ self.round_value(r, right)
+        return (left << self.halfbits) | right
+
+    def decrypt(self, x):
+        left, right = x >> self.halfbits, x & self.mask
+        for r in reversed(range(0, self.rounds)):
+            left, right = right ^ self.round_value(r, left), left
+        return (left << self.halfbits) | right
+
+    def permute(self, i):
+        if i < 0 or i >= self.size:
+            raise IndexError("value out of range")
+        i = self.encrypt(i)
+        while i >= self.size:
+            i = self.encrypt(i)
+        return i
+
+    def inverse(self, i):
+        if i < 0 or i >= self.size:
+            raise IndexError("value out of range")
+        i = self.decrypt(i)
+        while i >= self.size:
+            i = self.decrypt(i)
+        return i
+
+
+
 class Drawable(object):
+    """
+    Base class for anything that is drawn on a ticket.
+
+    Drawables whose output does not depend on the ticket number
+    or label should set static to True. Those are drawn only once
+    into a form and the form is placed on every ticket.
+    """
+    static = False
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
         
     def draw(self, canvas, ticket):
         pass
+
+    def prefetch(self, cells, executor):
+        """
+        Hook to prepare expensive data for the cells of a page
+        ahead of drawing them, using the given executor.
+        """
+        pass
       
         
 class Border(Drawable):
@@ -59,6 +494,8 @@ class Border(Drawable):
     Draw a border around the ticket. 
     For debugging mainly.
     """
+    static = True
+
     def __init__(self, color=black, linewidth=0.25*mm):
         super().__init__(0, 0)
         self.color = color
@@ -76,14 +513,229 @@ class Image(Drawable):
     Draw a background image. The image should have
     the same proportions as the ticket, otherwise
     it will be distorsioned
+
+    The image is decoded and compressed only once per process and
+    kept in image_cache, keyed by path, modification time and size.
+    If a disk cache is set with set_disk_cache, the compressed image
+    is also stored there and reused by later runs.
+    If dpi is given, the image is downsampled to that resolution
+    at the size of the ticket before it is embedded.
+    Only images given by a file name are cached and downsampled,
+    other sources such as an ImageReader or a PIL image are
+    prepared again for every canvas.
     """
-    def __init__(self, image):
+    static = True
+
+    def __init__(self, image, dpi=None):
         super().__init__(0, 0)
         self.image = image
-        
+        self.dpi = dpi
+
+    def get_size(self, width, height):
+        """
+        Pixel size for the ticket size, None to keep the image as is.
+        """
+        if self.dpi is None:
+            return None
+        return (max(1, round(width / 72 * self.dpi)), max(1, round(height / 72 * self.dpi)))
+
+    def get_xobject(self, width, height):
+        """
+        Prepared image XObject for a ticket of the given size.
+        """
+        if not isinstance(self.image, (str, bytes, os.PathLike)):
+            reader = self.image
+            if not isinstance(reader, ImageReader):
+                reader = ImageReader(reader)
+            return pdfdoc.PDFImageXObject("img{0}".format(next(serials)), reader)
+        path = os.path.abspath(self.image)
+        size = self.get_size(width, height)
+        key = (path, os.path.getmtime(path), size)
+        xobj = image_cache.get(key)
+        if xobj is None:
+            name = "img{0}".format(hashlib.md5(repr(key).encode("utf-8")).hexdigest())
+            diskkey = None
+            if disk_cache is not None:
+                diskkey = disk_cache.get_key(path, ("Image", size))
+                entry = disk_cache.get_data(diskkey)
+                if entry is not None:
+                    xobj = self.load_xobject(name, *entry)
+            if xobj is None:
+                xobj = self.make_xobject(name, path, size)
+                if diskkey is not None:
+                    disk_cache.put_data(diskkey, *self.dump_xobject(xobj))
+            image_cache.put(key, xobj)
+        return xobj
+
+    def make_xobject(self, name, path, size):
+        reader = ImageReader(path)
+        if size is not None:
+            from PIL import Image as PILImage
+            img = PILImage.open(path)
+            if size[0] < img.size[0] and size[1] < img.size[1]:
+                reader = ImageReader(img.resize(size, PILImage.LANCZOS))
+        return pdfdoc.PDFImageXObject(name, reader)
+
+    xobject_attrs = ("width", "height", "bitsPerComponent", "colorSpace", "_filters", "mask")
+
+    def dump_xobject(self, xobj):
+        """
+        The attributes of a prepared image as stored in the disk
+        cache, a tuple (meta, data) of JSON metadata and the
+        compressed image data.
+        """
+        meta = dict((attr, getattr(xobj, attr)) for attr in self.xobject_attrs)
+        data = xobj.streamContent
+        # the data is text if it is ASCII85 encoded
+        meta["text"] = isinstance(data, str)
+        if meta["text"]:
+            data = data.encode("latin-1")
+        return meta, data
+
+    def load_xobject(self, name, meta, data):
+        """
+        Prepared image from the disk cache, None if the entry
+        does not hold all attributes.
+        """
+        if set(meta) != set(self.xobject_attrs + ("text",)):
+            return None
+        xobj = pdfdoc.PDFImageXObject(name)
+        for attr in self.xobject_attrs:
+            setattr(xobj, attr, meta[attr])
+        xobj._filters = tuple(meta["_filters"])
+        if meta["text"] is True:
+            data = data.decode("latin-1")
+        xobj.streamContent = data
+        return xobj
+
+    def draw(self, canvas, ticket):
+        xobj = self.get_xobject(ticket.width, ticket.height)
+        doc = canvas._doc
+        regname = doc.getXObjectName(xobj.name)
+        if regname not in doc.idToObject:
+            # every document needs an instance of its own, the
+            # compressed image data is shared
+            imgobj = copy.copy(xobj)
+            doc.Reference(imgobj, regname)
+            doc.addForm(xobj.name, imgobj)
+        canvas.saveState()
+        canvas.translate(ticket.x, ticket.y)
+        canvas.scale(ticket.width, ticket.height)
+        canvas.doForm(xobj.name)
+        canvas.restoreState()
+
+
+
+class PdfImage(Drawable):
+    """
+    Draw a page of an existing PDF file as background. The page is
+    read once and embedded as a form, so vector artwork stays vector.
+    Like Image it is stretched to the size of the ticket.
+    Requires pdfrw.
+    """
+    static = True
+
+    def __init__(self, filename, page=0):
+        super().__init__(0, 0)
+        self.filename = filename
+        self.page = page
+        self.xobj = None
+
+    def __getstate__(self):
+        # the parsed page is read again in other processes
+        state = self.__dict__.copy()
+        state["xobj"] = None
+        return state
+
+    def get_xobj(self):
+        if self.xobj is None:
+            from pdfrw import PdfReader
+            from pdfrw.buildxobj import pagexobj
+            self.xobj = pagexobj(PdfReader(self.filename).pages[self.page])
+        return self.xobj
+
+    def forget_document(self, doc):
+        """
+        Remove the reportlab objects pdfrw derived for doc from the
+        parsed page, so that the page does not keep the document
+        alive once it is written.
+        """
+        from pdfrw import PdfDict, PdfArray
+        todo = [self.xobj]
+        seen = set()
+        while len(todo) > 0:
+            obj = todo.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            derived = getattr(obj, "derived_rl_obj", None)
+            if derived is not None:
+                derived.pop(doc, None)
+            if isinstance(obj, PdfDict):
+                todo.extend(obj.values())
+            elif isinstance(obj, PdfArray):
+                todo.extend(obj)
+
+    def draw(self, canvas, ticket):
+        from pdfrw.toreportlab import makerl
+        xobj = self.get_xobj()
+        x0, y0, x1, y1 = [float(v) for v in xobj.BBox]
+        canvas.saveState()
+        canvas.translate(ticket.x, ticket.y)
+        canvas.scale(ticket.width / (x1 - x0), ticket.height / (y1 - y0))
+        canvas.translate(-x0, -y0)
+        canvas.doForm(makerl(canvas, xobj))
+        canvas.restoreState()
+        self.forget_document(canvas._doc)
+
+
+
+class SvgImage(Drawable):
+    """
+    Draw SVG artwork as vector graphics. The file is converted only
+    once per process (and once overall if a disk cache is set) and,
+    being static, drawn once into the form of the ticket.
+    Like Box it is placed at x, y and scaled to width and height;
+    if width or height are None the ticket size is used.
+    Requires svglib.
+    """
+    static = True
+
+    def __init__(self, filename, x=0, y=0, width=None, height=None):
+        super().__init__(x, y)
+        self.filename = filename
+        self.width = width
+        self.height = height
+
+    def get_drawing(self):
+        path = os.path.abspath(self.filename)
+        key = ("SvgImage", path, os.path.getmtime(path))
+        drawing = image_cache.get(key)
+        if drawing is None:
+            diskkey = None
+            if disk_cache is not None:
+                diskkey = disk_cache.get_key(path, ("SvgImage",))
+                drawing = disk_cache.get(diskkey)
+            if drawing is None:
+                from svglib.svglib import svg2rlg
+                drawing = svg2rlg(path)
+                if drawing is None:
+                    raise ValueError("could not read SVG file {0}".format(self.filename))
+                if diskkey is not None:
+                    disk_cache.put(diskkey, drawing)
+            image_cache.put(key, drawing)
+        return drawing
+
     def draw(self, canvas, ticket):
-        canvas.drawImage(self.image, ticket.x, ticket.y, 
-                         width=ticket.width, height=ticket.height)
+        from reportlab.graphics import renderPDF
+        drawing = self.get_drawing()
+        width = ticket.width if self.width is None else self.width
+        height = ticket.height if self.height is None else self.height
+        canvas.saveState()
+        canvas.translate(ticket.x+self.x, ticket.y+self.y)
+        canvas.scale(width / drawing.width, height / drawing.height)
+        renderPDF.draw(drawing, canvas, 0, 0)
+        canvas.restoreState()
 
 
 
@@ -92,6 +744,8 @@ class Box(Drawable):
     Draw a box with rounded corner. Can be used as background for 
     the counter
     """
+    static = True
+
     def __init__(self, x, y, width, height, bordercolor=black,
                  borderwidth=0.25*mm, background=white, radius=3*mm):
         super().__init__(x, y)
@@ -123,10 +777,13 @@ class QrCodeDrawable(Drawable):
         This can be used to dynamically build URLs
 
     datasource: can be either LABEL or NUMBER
+
+    vector: if True the modules of the QR code are drawn as filled
+        rectangles instead of embedding a bitmap for every ticket.
     """
     def __init__(self, x, y, size, template="{0}", datasource=NUMBER, box_size=4, version=1, 
                  fit=True, border=4, error_correction=qrcode.constants.ERROR_CORRECT_L,
-                 fill_color="black", back_color="white"):
+                 fill_color="black", back_color="white", vector=False):
         super().__init__(x, y)
         self.template = template
         self.datasource = datasource
@@ -138,21 +795,80 @@ class QrCodeDrawable(Drawable):
         self.box_size = box_size
         self.error_correction = error_correction
         self.border = border
-        
-    def draw(self, canvas, ticket):
-        canvas.saveState()
-        qr = qrcode.QRCode(version=self.version, box_size=self.box_size, error_correction=self.error_correction, border=self.border)
+        self.vector = vector
+
+    def get_payload(self, number, label):
         if self.datasource == NUMBER:
-            qr.add_data(self.template.format(ticket.number))
+            return self.template.format(number)
         elif self.datasource == LABEL:
-            qr.add_data(self.template.format(ticket.get_label()))
-        qr.make(fit=self.fit)
+            return self.template.format(label)
+
+    def get_data(self, ticket):
+        return self.get_payload(ticket.number, ticket.get_label())
+
+    def get_key(self, data):
+        return (data, self.version, self.error_correction, self.border, self.box_size, self.fit)
+
+    def make_qrcode(self, ticket):
+        """
+        Look up the encoded QR code of the ticket in the cache
+        and encode it if it is missing.
+        """
+        key = self.get_key(self.get_data(ticket))
+        qr = qrcode_cache.get(key)
+        if qr is None:
+            qr = encode_qrcode(*key)
+            qrcode_cache.put(key, qr)
+        return qr
+
+    def prefetch(self, cells, executor):
+        """
+        Submit the encoding of all QR codes of a page that
+        are not cached yet to the executor.
+        """
+        for col, row, number, label in cells:
+            key = self.get_key(self.get_payload(number, label))
+            if key not in qrcode_cache:
+                qrcode_cache.put(key, executor.submit(encode_qrcode, *key))
+
+    def draw_image(self, canvas, ticket, qr):
         pil_img = qr.make_image(fill_color=self.fill_color, back_color= self.back_color)
         img_io = io.BytesIO()
         pil_img.save(img_io, format='png')
         img_io.seek(0)
         img = ImageReader(img_io)
         canvas.drawImage(img, ticket.x+self.x, ticket.y+self.y, width=self.size, height=self.size)
+
+    def draw_vector(self, canvas, ticket, matrix):
+        """
+        Draw the module matrix as one filled path. Runs of dark
+        modules within a row are merged into a single rectangle.
+        """
+        modsize = self.size / len(matrix)
+        top = ticket.y + self.y + self.size
+        if self.back_color is not None:
+            canvas.setFillColor(self.back_color)
+            canvas.rect(ticket.x+self.x, ticket.y+self.y, self.size, self.size, stroke=0, fill=1)
+        canvas.setFillColor(self.fill_color)
+        path = canvas.beginPath()
+        for r, modules in enumerate(matrix):
+            y = top - (r+1) * modsize
+            start = None
+            for c, dark in enumerate(modules + [False]):
+                if dark and start is None:
+                    start = c
+                elif not dark and start is not None:
+                    path.rect(ticket.x+self.x+start*modsize, y, (c-start)*modsize, modsize)
+                    start = None
+        canvas.drawPath(path, stroke=0, fill=1)
+
+    def draw(self, canvas, ticket):
+        canvas.saveState()
+        qr = self.make_qrcode(ticket)
+        if self.vector is True:
+            self.draw_vector(canvas, ticket, qr.get_matrix())
+        else:
+            self.draw_image(canvas, ticket, qr)
         canvas.restoreState()
 
 
@@ -160,7 +876,13 @@ class QrCodeDrawable(Drawable):
 class FontDrawable(Drawable):
     """
     Base class for any drawables which draw strings on the ticket
+
+    Drawables with batch set to True can hand their string to the
+    ticket instead of drawing it, so that the strings of all tickets
+    on a page are written together in one text object.
     """
+    batch = False
+
     def __init__(self, x, y, color, fontname, fontsize):
         super().__init__(x, y)
         self.color = color
@@ -178,7 +900,15 @@ class FontDrawable(Drawable):
             canvas.setFillColor(self.color)
         if self.fontname is not None:
             canvas.setFont(self.fontname, self.fontsize)
-        
+
+    def get_metrics(self, canvas):
+        """
+        Cached metrics of the font the string is drawn with,
+        the current font of the canvas if fontname is None.
+        """
+        if self.fontname is None:
+            return get_font_metrics(canvas._fontname, canvas._fontsize)
+        return get_font_metrics(self.fontname, self.fontsize)
         
         
 class FontHorzDrawable(FontDrawable):
@@ -190,13 +920,35 @@ class FontHorzDrawable(FontDrawable):
         super().__init__(x, y, color, fontname, fontsize)
         self.alignment = alignment
         
-    def draw_str(self, canvas, ticket, s):
-        if self.alignment == ALIGNLEFT:
-            canvas.drawString(ticket.x+self.x, ticket.y+self.y, s)
-        elif self.alignment == ALIGNRIGHT:
-            canvas.drawRightString(ticket.x+self.x, ticket.y+self.y, s)
+    def get_str(self, ticket):
+        """
+        The string to draw on the ticket, implemented by subclasses.
+        """
+        return ""
+
+    def get_origin(self, canvas, ticket, s):
+        """
+        Start of the string on the canvas, taking the alignment
+        into account.
+        """
+        if self.alignment == ALIGNRIGHT:
+            return ticket.x+self.x-self.get_metrics(canvas).string_width(s), ticket.y+self.y
         elif self.alignment == ALIGNCENTER:
-            canvas.drawCentredString(ticket.x+self.x, ticket.y+self.y, s)
+            return ticket.x+self.x-self.get_metrics(canvas).string_width(s)/2, ticket.y+self.y
+        return ticket.x+self.x, ticket.y+self.y
+
+    def draw_str(self, canvas, ticket, s):
+        x, y = self.get_origin(canvas, ticket, s)
+        canvas.drawString(x, y, s)
+
+    def collect(self, batch, canvas, ticket):
+        """
+        Add the string of the ticket to a TextBatch instead of
+        drawing it.
+        """
+        s = self.get_str(ticket)
+        x, y = self.get_origin(canvas, ticket, s)
+        batch.add(self.fontname, self.fontsize, self.color, x, y, s)
 
 
 
@@ -206,13 +958,13 @@ class FontVertDrawable(FontDrawable):
         self.direction = direction
         
     def draw_str(self, canvas, ticket, s):
-        fh = get_font_height(self.fontname, self.fontsize)
+        metrics = self.get_metrics(canvas)
         if self.direction == COUNTERCLOCKWISE:
-            canvas.translate(ticket.x+self.x+fh, ticket.y+self.y)
+            canvas.translate(ticket.x+self.x+metrics.height, ticket.y+self.y)
             canvas.rotate(90)
             canvas.drawString(0, 0, s)
         elif self.direction == CLOCKWISE:
-            sw = pdfmetrics.stringWidth(self.label, self.fontname, self.fontsize)
+            sw = metrics.string_width(s)
             canvas.translate(ticket.x+self.x, ticket.y+self.y+sw)
             canvas.rotate(-90)
             canvas.drawString(0, 0, s)
@@ -222,15 +974,20 @@ class Counter(FontHorzDrawable):
     """
     Draw the counter as a number on the ticket
     """
+    batch = True
+
     def __init__(self, x, y, color=None, fontname=None, fontsize=12, digits=5, alignment=ALIGNLEFT):
         super().__init__(x, y, color, fontname, fontsize)
         self.alignment = alignment
         self.digits = digits
+
+    def get_str(self, ticket):
+        return format_number(self.digits, ticket.number)
         
     def draw(self, canvas, ticket):
         canvas.saveState()
         super().draw(canvas, ticket)
-        self.draw_str(canvas, ticket, format_number(self.digits, ticket.number))
+        self.draw_str(canvas, ticket, self.get_str(ticket))
         canvas.restoreState()
 
 
@@ -253,13 +1010,18 @@ class Label(FontHorzDrawable):
     """
     Draw a string on the ticket
     """
+    batch = True
+
     def __init__(self, x, y, color=None, fontname=None, fontsize=12, alignment=ALIGNLEFT):
-        super().__init__(x, y, color, fontname, fontsize, alignment)
+        super().__init__(x, y, color, fontname, fontsize, alignment=alignment)
+
+    def get_str(self, ticket):
+        return ticket.get_label()
         
     def draw(self, canvas, ticket):
         canvas.saveState()
         super().draw(canvas, ticket)
-        self.draw_str(canvas, ticket, ticket.get_label())
+        self.draw_str(canvas, ticket, self.get_str(ticket))
         canvas.restoreState()
         
         
@@ -291,6 +1053,39 @@ class RotatedLabel(FontDrawable):
 
 
 
+class TextBatch(object):
+    """
+    Strings of a page grouped by font, size and color. Every group
+    is written as a single text object that moves from one string
+    to the next with Td, instead of saving and restoring the
+    graphics state and setting font and color for every string.
+    """
+    def __init__(self):
+        self.groups = OrderedDict()
+
+    def add(self, fontname, fontsize, color, x, y, s):
+        self.groups.setdefault((fontname, fontsize, color), []).append((x, y, s))
+
+    def draw(self, canvas):
+        for (fontname, fontsize, color), strings in self.groups.items():
+            canvas.saveState()
+            x0, y0, s = strings[0]
+            text = canvas.beginText(x0, y0)
+            text.setFont(fontname, fontsize)
+            if color is not None:
+                text.setFillColor(color)
+            text.textOut(s)
+            for x, y, s in strings[1:]:
+                # moveCursor counts dy downwards
+                text.moveCursor(x - x0, y0 - y)
+                text.textOut(s)
+                x0, y0 = x, y
+            canvas.drawText(text)
+            canvas.restoreState()
+        self.groups.clear()
+
+
+
 class Ticket(object):
     def __init__(self, width, height):
         self.width = width
@@ -301,6 +1096,12 @@ class Ticket(object):
         self.y = 0
         self.drawables = []
         self.label = ""
+        self.layers = None
+        self.formcanvas = None
+        self.serial = next(serials)
+        self.profiler = None
+        self.textdrawables = []
+        self.textbatch = None
         
     def get_label(self):
         return self.label
@@ -310,6 +1111,7 @@ class Ticket(object):
         
     def add_drawable(self, drawable):
         self.drawables.append(drawable)
+        self.layers = None
         
     def set_origin(self, x, y):
         self.x = x
@@ -318,12 +1120,259 @@ class Ticket(object):
     def set_number(self, number):
         self.number = number
         
-    def paint(self, canvas):
+    def get_layers(self):
+        """
+        Group the drawables into layers while keeping their order.
+        Consecutive static drawables are merged into one layer that
+        is painted as a form, every dynamic drawable is a layer on
+        its own. Returns a list of (formname, drawables) tuples,
+        formname is None for dynamic layers.
+        """
+        if self.layers is None:
+            self.layers = []
+            # new names, the old forms may already be on a canvas
+            self.serial = next(serials)
+            for drawable in self.drawables:
+                if drawable.static is True:
+                    if len(self.layers) == 0 or self.layers[-1][0] is None:
+                        formname = "ticket{0}_{1}".format(self.serial, len(self.layers))
+                        self.layers.append((formname, []))
+                    self.layers[-1][1].append(drawable)
+                else:
+                    self.layers.append((None, [drawable]))
+            self.textdrawables = []
+            for drawable in reversed(self.drawables):
+                if getattr(drawable, "batch", False) is not True or drawable.fontname is None:
+                    break
+                self.textdrawables.insert(0, drawable)
+            self.formcanvas = None
+        return self.layers
+
+    def begin_batch(self):
         """
-        Paint ticket on the canvas.
+        Start collecting the strings of the text drawables that are
+        painted last on the ticket into a TextBatch, instead of
+        drawing them right away. Only the trailing text drawables are
+        collected, so nothing else is drawn on top of them anyway.
+        """
+        self.textbatch = TextBatch()
+
+    def end_batch(self, canvas):
+        """
+        Draw the collected strings and stop collecting.
+        """
+        if self.textbatch is not None:
+            self.textbatch.draw(canvas)
+            self.textbatch = None
+
+    def make_forms(self, canvas, background=True):
+        """
+        Draw the static layers once into forms on the canvas.
+        The forms are drawn with the ticket origin at 0, 0.
+        If background is False, the form of the static drawables
+        below all dynamic drawables is left out until it is needed.
+        Forms the document of the canvas already holds are kept, so
+        the ticket can be painted on several canvases in turn.
+        """
+        x, y = self.x, self.y
+        self.set_origin(0, 0)
+        for i, (formname, drawables) in enumerate(self.get_layers()):
+            if formname is None or (i == 0 and background is False) or has_form(canvas, formname):
+                continue
+            canvas.beginForm(formname, 0, 0, self.width, self.height)
+            for drawable in drawables:
+                if self.profiler is None:
+                    drawable.draw(canvas, self)
+                else:
+                    self.profiler.draw(drawable, canvas, self)
+            end_form(canvas)
+        self.set_origin(x, y)
+        self.formcanvas = canvas
+
+    def prefetch(self, cells, executor):
+        """
+        Let the dynamic drawables prepare the cells of a page.
         """
         for drawable in self.drawables:
-            drawable.draw(canvas, self)
+            if drawable.static is not True:
+                drawable.prefetch(cells, executor)
+
+    def has_background(self):
+        """
+        True if the ticket starts with static drawables, which can be
+        painted on their own with paint_background.
+        """
+        layers = self.get_layers()
+        return len(layers) > 0 and layers[0][0] is not None
+
+    def has_background_form(self, canvas):
+        """
+        True unless the background form is still missing on the canvas.
+        """
+        return not self.has_background() or has_form(canvas, self.get_layers()[0][0])
+
+    def paint_background(self, canvas):
+        """
+        Paint only the static drawables that lie below all dynamic
+        drawables of the ticket.
+        """
+        if self.formcanvas is not canvas or not self.has_background_form(canvas):
+            self.make_forms(canvas)
+        if self.has_background():
+            self.place_form(canvas, self.get_layers()[0][0])
+
+    def paint(self, canvas, background=True):
+        """
+        Paint ticket on the canvas. Static drawables are
+        only drawn once per canvas and then re-used.
+        If background is False, the static drawables below all
+        dynamic drawables are left out, so that the ticket can be
+        put on top of a background painted with paint_background.
+        """
+        layers = self.get_layers()
+        if self.formcanvas is not canvas or (background is True and not self.has_background_form(canvas)):
+            self.make_forms(canvas, background)
+        if background is False and self.has_background():
+            layers = layers[1:]
+        profiler = self.profiler
+        if self.textbatch is not None and len(self.textdrawables) > 0:
+            layers = layers[:len(layers)-len(self.textdrawables)]
+            for drawable in self.textdrawables:
+                if profiler is None:
+                    drawable.collect(self.textbatch, canvas, self)
+                else:
+                    profiler.collect(drawable, self.textbatch, canvas, self)
+        for formname, drawables in layers:
+            if formname is None:
+                for drawable in drawables:
+                    if profiler is None:
+                        drawable.draw(canvas, self)
+                    else:
+                        profiler.draw(drawable, canvas, self)
+            elif profiler is None:
+                self.place_form(canvas, formname)
+            else:
+                profiler.call(("form", formname), canvas, self.place_form, canvas, formname)
+
+    def paint_rotated(self, canvas):
+        """
+        Paint the ticket turned by 90 degrees counterclockwise, so
+        that it covers height x width from its origin. The strings of
+        the ticket are drawn right away instead of being batched.
+        """
+        x, y = self.x, self.y
+        textbatch = self.textbatch
+        self.textbatch = None
+        canvas.saveState()
+        canvas.translate(x + self.height, y)
+        canvas.rotate(90)
+        self.set_origin(0, 0)
+        self.paint(canvas)
+        canvas.restoreState()
+        self.set_origin(x, y)
+        self.textbatch = textbatch
+
+    def place_form(self, canvas, formname):
+        canvas.saveState()
+        canvas.translate(self.x, self.y)
+        canvas.doForm(formname)
+        canvas.restoreState()
+
+
+class StreamingCanvas(Canvas):
+    """
+    Canvas that writes every page to the output file as soon as the
+    page is finished instead of keeping all pages in memory until
+    save is called. The content stream, the page dictionary and the
+    images first drawn on the page, e.g. QR codes, are written and
+    dropped; their names stay registered so they are referenced
+    rather than added again. Forms and fonts are written when the
+    canvas is saved, together with the cross reference table and
+    the trailer. Encryption is not supported.
+    """
+    def __init__(self, filename, *args, **kwargs):
+        if kwargs.get("encrypt") is not None:
+            raise ValueError("StreamingCanvas does not support encryption")
+        super().__init__(filename, *args, **kwargs)
+        self.outfile = open(filename, "wb")
+        self.offset = 0
+        self.written = set()
+        self.lastobject = self._doc.objectcounter
+        self.write(pdfdoc.PDFFile(self._doc._pdfVersion).format(self._doc))
+
+    def write(self, data):
+        data = pdfdoc.pdfdocEnc(data)
+        self.outfile.write(data)
+        self.offset += len(data)
+
+    def write_object(self, name):
+        """
+        Write the registered object with the given internal name
+        to the file and drop it from memory.
+        """
+        doc = self._doc
+        data = pdfdoc.PDFIndirectObject(name, doc.idToObject[name]).format(doc)
+        doc.idToOffset[name] = self.offset
+        self.write(data)
+        doc.idToObject[name] = None
+        self.written.add(name)
+
+    def showPage(self):
+        super().showPage()
+        doc = self._doc
+        page = doc.Pages.pages[-1]
+        page.check_format(doc)
+        page.Contents = doc.Reference(page.Contents)
+        page.stream = None
+        self.write_object(page.Contents.name)
+        for number in range(self.lastobject + 1, doc.objectcounter + 1):
+            name = doc.numberToId.get(number)
+            if isinstance(doc.idToObject.get(name), pdfdoc.PDFImageXObject):
+                self.write_object(name)
+        name = page.__InternalName__
+        self.write_object(name)
+        # the page tree only needs the reference
+        doc.Pages.pages[-1] = pdfdoc.PDFObjectReference(name)
+        self.lastobject = doc.objectcounter
+
+    def save(self):
+        """
+        Write the remaining objects, the cross reference table and
+        the trailer and close the file. Follows what reportlab does
+        in PDFDocument.GetPDFData and PDFDocument.format but skips
+        the page streams that have already been written.
+        """
+        if len(self._code):
+            self.showPage()
+        doc = self._doc
+        for fnt in doc.delayedFonts:
+            fnt.addObjects(doc)
+        doc.info.invariant = doc.invariant
+        doc.info.digest(doc.signature)
+        doc.Reference(doc.Catalog)
+        doc.Reference(doc.info)
+        doc.Outlines.prepare(doc, self)
+        if doc.Outlines.ready < 0:
+            doc.Catalog.Outlines = None
+        doc.encrypt.prepare(doc)
+        ids = []
+        counter = 1
+        while counter in doc.numberToId:
+            name = doc.numberToId[counter]
+            if name not in self.written:
+                self.write_object(name)
+            ids.append(name)
+            counter += 1
+        xref = pdfdoc.PDFCrossReferenceTable()
+        xref.addsection(0, ids)
+        xrefoffset = self.offset
+        self.write(xref.format(doc))
+        trailer = pdfdoc.PDFTrailer(startxref=xrefoffset, Size=len(ids)+1,
+                                    Root=doc.Reference(doc.Catalog),
+                                    Info=doc.Reference(doc.info),
+                                    ID=doc.ID())
+        self.write(trailer.format(doc))
+        self.outfile.close()
 
 
 class PageLayout(object):
@@ -360,10 +1409,30 @@ class PageLayout(object):
         Top margin
     right: float
         Right margin
+
+    labels: list or iterable of strings
+        Labels of the tickets. A list is consumed from its end, any
+        other iterable such as an open file is consumed lazily from
+        its start, trailing line breaks are removed.
+
+    seed: integer or string
+        Seed of the permutation used for RANDOMORDER. The same seed
+        always gives the same layout. If None a random seed is chosen.
+
+    rotation: int
+        How the tickets may be turned to fit more of them on a page.
+        NOROTATION: Tickets are laid out as they are.
+        AUTOROTATION: Tickets are turned by 90 degrees if this gives
+        more tickets per page.
+        MIXEDROTATION: Like AUTOROTATION, but the strip of paper left
+        over by the grid may be filled with tickets turned the other
+        way.
     """
     def __init__(self, ticket, numtickets, numoffset=0, pagesize=A4, cropmarks=(5*mm, 0.25*mm), bleed=2*mm, 
-                 bottom=15*mm, left=15*mm, top=15*mm, right=15*mm, labels=[]):
+                 bottom=15*mm, left=15*mm, top=15*mm, right=15*mm, labels=[], seed=None,
+                 rotation=NOROTATION):
         self.ticket = ticket
+        self.rotation = rotation
         self.numtickets = numtickets
         self.numoffset = numoffset
         self.cropmarks = cropmarks
@@ -381,7 +1450,13 @@ class PageLayout(object):
         self.usable_pageheight = None
         self.numbers=[]
         self.labels = labels
-        
+        self.labeliter = None
+        if seed is None:
+            seed = getrandbits(64)
+        self.seed = seed
+        self.permutation = None
+        self.profiler = None
+
     def set_margins(self, minmargins):
         """
         Setting the page margins will re-calculate the number of
@@ -394,19 +1469,73 @@ class PageLayout(object):
             return
         self.usable_pagewidth = self.pagesize[0] - 2 * self.cropmarks[0] - minmargins.left - minmargins.right
         self.usable_pageheight = self.pagesize[1] - 2* self.cropmarks[0] - minmargins.bottom - minmargins.top
-        self.colcount = int(self.usable_pagewidth / self.ticket.width)
-        self.rowcount = int(self.usable_pageheight / self.ticket.height)
-        self.tickets_per_page = self.colcount * self.rowcount
+        left = minmargins.left + self.cropmarks[0]
+        top = minmargins.top + self.cropmarks[0]
+        self.blocks = self.get_blocks(left, self.pagesize[1] - top)
+        self.colcount = self.blocks[0].cols
+        self.rowcount = self.blocks[0].rows
+        self.tickets_per_page = sum(block.cols * block.rows for block in self.blocks)
         self.ticket_on_last_page = self.numtickets % self.tickets_per_page
         self.numpages = ceil(self.numtickets / self.tickets_per_page)
         self.minmargins = minmargins
-        left = minmargins.left + self.cropmarks[0]
-        right = left + self.colcount * self.ticket.width
-        top = minmargins.top + self.cropmarks[0]
-        bottom = top + self.rowcount * self.ticket.height
-        self.realmargins = Margins(self.pagesize[1]-bottom, left, top, self.pagesize[0]-right)
+        right = max(block.left + block.cols * block.width for block in self.blocks)
+        bottom = min(block.top - block.rows * block.height for block in self.blocks)
+        self.realmargins = Margins(bottom, left, top, self.pagesize[0]-right)
+        self.origins = []
+        self.cells = []
+        self.rotations = []
+        for block in self.blocks:
+            coloffset = self.colcount if block.left > left else 0
+            rowoffset = self.rowcount if block.top < self.pagesize[1] - top else 0
+            for row in range(0, block.rows):
+                for col in range(0, block.cols):
+                    self.origins.append(self.get_cell(col, row, block))
+                    self.cells.append((coloffset + col, rowoffset + row))
+                    self.rotations.append(block.rotated)
+        self.cropmarklines = self.get_cropmark_lines()
+        self.cropmarkform = "cropmarks{0}".format(next(serials))
+        self.cropmarkcanvas = None
         
         
+    def get_blocks(self, left, top):
+        """
+        Arrange the tickets on the usable area of the page whose top
+        left corner is at left, top. Returns a list of Blocks, i.e.
+        grids of cells of the same orientation. The first one is the
+        main grid, a second one fills the strip on its right or below
+        it with turned tickets. Among the arrangements allowed by the
+        rotation of the layout the one with the most tickets wins,
+        on a tie the tickets are rather not turned.
+        """
+        width, height = self.ticket.width, self.ticket.height
+        orientations = [(width, height, False)]
+        if self.rotation != NOROTATION:
+            orientations.append((height, width, True))
+        best, bestcount = None, -1
+        for width, height, rotated in orientations:
+            cols = int(self.usable_pagewidth / width)
+            rows = int(self.usable_pageheight / height)
+            candidates = [[Block(left, top, cols, rows, width, height, rotated)]]
+            if self.rotation == MIXEDROTATION:
+                for k in range(1, cols + 1):
+                    strip = self.usable_pagewidth - k * width
+                    candidates.append([Block(left, top, k, rows, width, height, rotated),
+                                       Block(left + k * width, top, int(strip / height),
+                                             int(self.usable_pageheight / width),
+                                             height, width, not rotated)])
+                for k in range(1, rows + 1):
+                    strip = self.usable_pageheight - k * height
+                    candidates.append([Block(left, top, cols, k, width, height, rotated),
+                                       Block(left, top - k * height,
+                                             int(self.usable_pagewidth / height),
+                                             int(strip / width), height, width, not rotated)])
+            for blocks in candidates:
+                blocks = [block for block in blocks if block.cols * block.rows > 0] or blocks[:1]
+                tickets = sum(block.cols * block.rows for block in blocks)
+                if tickets > bestcount:
+                    best, bestcount = blocks, tickets
+        return best
+
     def set_pagesize(self, pagesize):
         """
         Real margins are re-calculated when setting the pagesize
@@ -432,43 +1561,71 @@ class PageLayout(object):
                     
         canvas.restoreState()
         
+    def get_cropmark_lines(self):
+        """
+        Compute the line segments of the cropmarks as a list
+        of (x1, y1, x2, y2) tuples. Every block of cells gets
+        cropmarks on its sides, except for marks that would lie
+        on the cells of another block.
+        """
+        length = self.cropmarks[0]
+        lines = []
+        edges = [(block.left, block.left + block.cols * block.width,
+                  block.top - block.rows * block.height, block.top) for block in self.blocks]
+
+        def add(x1, y1, x2, y2):
+            x, y = (x1 + x2) / 2, (y1 + y2) / 2
+            if not any(left < x < right and bottom < y < top for left, right, bottom, top in edges):
+                lines.append((x1, y1, x2, y2))
+
+        for block, (left, right, bottom, top) in zip(self.blocks, edges):
+            for col in range(0, block.cols):
+                x1 = left + col * block.width + self.bleed
+                x2 = left + (col+1) * block.width - self.bleed
+                add(x1, bottom, x1, bottom - length)
+                add(x2, bottom, x2, bottom - length)
+                add(x1, top, x1, top + length)
+                add(x2, top, x2, top + length)
+            for row in range(0, block.rows):
+                y1 = bottom + self.bleed + row * block.height
+                y2 = bottom + (row+1) * block.height - self.bleed
+                add(left, y1, left - length, y1)
+                add(left, y2, left - length, y2)
+                add(right, y1, right + length, y1)
+                add(right, y2, right + length, y2)
+        return lines
+
     def paint_cropmarks(self, canvas):
-        canvas.saveState()
-        canvas.setLineWidth(self.cropmarks[1])
-        canvas.setStrokeColor(black)
-        for col in range(0, self.colcount):
-            canvas.line(self.realmargins.left+col*self.ticket.width+self.bleed, self.realmargins.bottom,
-                        self.realmargins.left+col*self.ticket.width+self.bleed, self.realmargins.bottom-self.cropmarks[0])
-            canvas.line(self.realmargins.left+(col+1)*self.ticket.width-self.bleed, self.realmargins.bottom,
-                        self.realmargins.left+(col+1)*self.ticket.width-self.bleed, self.realmargins.bottom-self.cropmarks[0])
-                        
-            canvas.line(self.realmargins.left+col*self.ticket.width+self.bleed, self.pagesize[1]-self.realmargins.top,
-                        self.realmargins.left+col*self.ticket.width+self.bleed, self.pagesize[1]-self.realmargins.top+self.cropmarks[0])
-            canvas.line(self.realmargins.left+(col+1)*self.ticket.width-self.bleed, self.pagesize[1]-self.realmargins.top,
-                        self.realmargins.left+(col+1)*self.ticket.width-self.bleed, self.pagesize[1]-self.realmargins.top+self.cropmarks[0])
-        for row in range(0, self.rowcount):
-            canvas.line(self.realmargins.left, self.realmargins.bottom+self.bleed+row*self.ticket.height,
-                        self.realmargins.left-self.cropmarks[0], self.realmargins.bottom+self.bleed+row*self.ticket.height)
-            canvas.line(self.realmargins.left, self.realmargins.bottom+(row+1)*self.ticket.height-self.bleed,
-                        self.realmargins.left-self.cropmarks[0], self.realmargins.bottom+(row+1)*self.ticket.height-self.bleed)
-                        
-            canvas.line(self.pagesize[0]-self.realmargins.right, self.realmargins.bottom+self.bleed+row*self.ticket.height,
-                        self.pagesize[0]-self.realmargins.right+self.cropmarks[0], self.realmargins.bottom+self.bleed+row*self.ticket.height)
-            canvas.line(self.pagesize[0]-self.realmargins.right, self.realmargins.bottom+(row+1)*self.ticket.height-self.bleed,
-                        self.pagesize[0]-self.realmargins.right+self.cropmarks[0], self.realmargins.bottom+(row+1)*self.ticket.height-self.bleed)
-            
-        
-        canvas.restoreState()
+        """
+        The cropmarks are the same on every page. They are drawn
+        once per canvas into a form which is then placed on every
+        page. The form is rebuilt when the margins or the pagesize
+        are changed.
+        """
+        if self.cropmarkcanvas is not canvas and not has_form(canvas, self.cropmarkform):
+            canvas.beginForm(self.cropmarkform, 0, 0, self.pagesize[0], self.pagesize[1])
+            canvas.setLineWidth(self.cropmarks[1])
+            canvas.setStrokeColor(black)
+            canvas.lines(self.cropmarklines)
+            canvas.endForm()
+            self.cropmarkcanvas = canvas
+        canvas.doForm(self.cropmarkform)
         
-    def get_cell(self, col, row):
+    def get_cell(self, col, row, block=None):
         """
-        Compute origin of cell defined by column and row
+        Compute origin of cell defined by column and row of a
+        block, by default the main grid. The origins of all cells
+        of a page are kept in the origins list, in the order the
+        cells are filled, their column and row in the cells list.
         """
-        x = self.realmargins.left + col * self.ticket.width
-        y = self.pagesize[1] - self.realmargins.top - (row+1) * self.ticket.height
+        if block is None:
+            block = self.blocks[0]
+        x = block.left + col * block.width
+        y = block.top - (row+1) * block.height
         return x, y
         
     def generate_numbers(self, order=STACKORDER, invert=False):
+        self.numbers = []
         for i in range(0, self.numpages):
                 self.numbers.append([])
         currentpage = 0
@@ -480,14 +1637,9 @@ class PageLayout(object):
                     currentpage += 1
                     self.numbers[currentpage].append(i)
         elif order == RANDOMORDER:
-            numbers = [i for i in range(self.numoffset, self.numtickets+self.numoffset)]
-            shuffle(numbers)
-            while len(numbers) > 0:
-                if len(self.numbers[currentpage]) < self.tickets_per_page:
-                    self.numbers[currentpage].append(numbers.pop())
-                else:
-                    currentpage += 1
-                    self.numbers[currentpage].append(numbers.pop())
+            for i in range(0, self.numtickets):
+                page, slot = divmod(i, self.tickets_per_page)
+                self.numbers[page].append(self.number_at(page, slot, order))
         elif order == STACKORDER:
             for i in range(self.numoffset, self.numtickets+self.numoffset):
                 self.numbers[currentpage].append(i)
@@ -498,13 +1650,166 @@ class PageLayout(object):
         if invert is True:
             self.numbers.reverse()
     
+    def get_page_index(self, page, invert=False):
+        """
+        Translate the index of a page in the document to the
+        index it would have without inverting the page order.
+        """
+        if invert is True:
+            return self.numpages - 1 - page
+        return page
+
+    def count_tickets(self, page, order=STACKORDER, invert=False):
+        """
+        Number of tickets on the page with the given index.
+        """
+        page = self.get_page_index(page, invert)
+        if page < 0 or page >= self.numpages:
+            raise IndexError("page index out of range")
+        if order == STACKORDER:
+            return ceil((self.numtickets - page) / self.numpages)
+        return min(self.tickets_per_page, self.numtickets - page * self.tickets_per_page)
+
+    def get_permutation(self):
+        """
+        Permutation used for RANDOMORDER. It is rebuilt whenever
+        the number of tickets or the seed change.
+        """
+        if (self.permutation is None or self.permutation.size != self.numtickets
+                or self.permutation.seed != self.seed):
+            self.permutation = Permutation(self.numtickets, self.seed)
+        return self.permutation
+
+    def number_at(self, page, slot, order=STACKORDER, invert=False):
+        """
+        Compute the number of the ticket in a slot of a page without
+        generating the numbers of the whole layout. Slots are counted
+        in the order the cells are filled, i.e. row by row starting
+        at the top left cell. Returns None for an empty slot.
+        """
+        if slot < 0 or slot >= self.tickets_per_page:
+            raise IndexError("slot index out of range")
+        if slot >= self.count_tickets(page, order, invert):
+            return None
+        page = self.get_page_index(page, invert)
+        if order == SEQUENTIALORDER:
+            return self.numoffset + page * self.tickets_per_page + slot
+        elif order == STACKORDER:
+            return self.numoffset + slot * self.numpages + page
+        elif order == RANDOMORDER:
+            i = page * self.tickets_per_page + slot
+            return self.numoffset + self.get_permutation().permute(i)
+        raise ValueError("unknown order {0}".format(order))
+
+    def slot_of(self, number, order=STACKORDER, invert=False):
+        """
+        Compute page and slot of a ticket number. This is the
+        inverse of number_at and returns a (page, slot) tuple.
+        """
+        i = number - self.numoffset
+        if i < 0 or i >= self.numtickets:
+            raise ValueError("number {0} is not part of the layout".format(number))
+        if order == SEQUENTIALORDER:
+            page, slot = divmod(i, self.tickets_per_page)
+        elif order == STACKORDER:
+            slot, page = divmod(i, self.numpages)
+        elif order == RANDOMORDER:
+            page, slot = divmod(self.get_permutation().inverse(i), self.tickets_per_page)
+        else:
+            raise ValueError("unknown order {0}".format(order))
+        return self.get_page_index(page, invert), slot
+
+    def get_page_numbers(self, page, order=STACKORDER, invert=False):
+        """
+        List of the ticket numbers on a page.
+        """
+        return [self.number_at(page, slot, order, invert)
+                for slot in range(0, self.count_tickets(page, order, invert))]
+
+    def label_offset(self, page, slot, order=STACKORDER, invert=False):
+        """
+        Index of the label used for the ticket in a slot of a page.
+        Labels are consumed in the order the tickets are laid out,
+        page by page in document order.
+        """
+        if order == STACKORDER:
+            base, extra = divmod(self.numtickets, self.numpages)
+            if invert is True:
+                longer = max(0, page - (self.numpages - extra))
+            else:
+                longer = min(page, extra)
+            return page * base + longer + slot
+        offset = page * self.tickets_per_page + slot
+        if invert is True and page > 0:
+            offset -= self.numpages * self.tickets_per_page - self.numtickets
+        return offset
+
+    def get_labels_at(self, offsets):
+        """
+        Look up the labels with the given offsets without consuming
+        the labels of the layout. Returns a dict mapping offset to
+        label. Labels which are not a list are read once from the
+        start, so a file is rewound first.
+        """
+        offsets = set(offsets)
+        if isinstance(self.labels, list):
+            size = len(self.labels)
+            return {i: self.labels[size-1-i] if i < size else "" for i in offsets}
+        result = dict.fromkeys(offsets, "")
+        if len(offsets) == 0:
+            return result
+        if hasattr(self.labels, "seek"):
+            self.labels.seek(0)
+            self.labeliter = None
+        last = max(offsets)
+        for i, label in enumerate(self.labels):
+            if i in result:
+                result[i] = label.rstrip("\r\n")
+            if i >= last:
+                break
+        return result
+
     def get_label(self):
-        try:
-            return self.labels.pop()
-        except IndexError:
-            return ""
+        if isinstance(self.labels, list):
+            try:
+                return self.labels.pop()
+            except IndexError:
+                return ""
+        if self.labeliter is None:
+            self.labeliter = iter(self.labels)
+        return next(self.labeliter, "").rstrip("\r\n")
+
+    def iter_pages(self, order=STACKORDER, invert=False, start=0):
+        """
+        Lazily lay out the tickets page by page. Yields a tuple
+        (page, cells) for every page from start on, where cells is
+        a list of (col, row, number, label) tuples in the order the
+        cells are filled. Only one page is held in memory at a time.
+        """
+        for page in range(start, self.numpages):
+            cells = []
+            for slot, number in enumerate(self.get_page_numbers(page, order, invert)):
+                col, row = self.cells[slot]
+                cells.append((col, row, number, self.get_label()))
+            yield page, cells
 
-    def generate(self, canvas, order=STACKORDER, cropmarks=True, invert=False):
+    def prefetch_pages(self, pages, executor, lookahead=2):
+        """
+        Pass the pages through while letting the drawables prepare
+        the next lookahead pages in the executor, so that QR codes
+        are already encoded when their page is painted.
+        """
+        queue = deque()
+        for page in pages:
+            self.ticket.prefetch(page[1], executor)
+            queue.append(page)
+            if len(queue) > lookahead:
+                yield queue.popleft()
+        while len(queue) > 0:
+            yield queue.popleft()
+
+    def generate(self, canvas, order=STACKORDER, cropmarks=True, invert=False, executor=None,
+                 profiler=None, index=None):
         """
         Layout tickets on canvas.
         
@@ -512,7 +1817,8 @@ class PageLayout(object):
         ----------
         
         canvas: Canvas
-            Canvas instance the tickets are laid out on.
+            Canvas instance the tickets are laid out on. Use a
+            StreamingCanvas to keep memory use flat on large runs.
             
         order: int
             The order in which the tickets are numbered.
@@ -520,6 +1826,7 @@ class PageLayout(object):
             every page, i.e. on each page from n to n+tickets-on-page.
             Best suited when pages are cut individually.
             RANDOMORDER: Tickets are numbered in random order.
+            The order only depends on the seed of the layout.
             STACKORDER: When all pages are piled up, ordering is
             from top to bottom, i.e. ticket 1 is on top of ticket 2,
             etc. This way, when cutting the whole pile at once
@@ -530,27 +1837,702 @@ class PageLayout(object):
             Invert the page order i.e. last page is first in document.
             Useful in case the printer output is piled up in reverse
             order.
+
+        executor: Executor
+            Optional thread or process pool. If given, expensive data
+            such as QR codes is prepared in the pool a few pages ahead
+            of the page being painted.
+
+        profiler: Profiler
+            Optional profiler that records where the time goes.
+
+        index: str
+            Optional name of a JobIndex file recording where every
+            ticket number is printed, see write_index.
+        """
+        if index is not None:
+            self.write_index(index, order=order, invert=invert)
+        pages = self.iter_pages(order=order, invert=invert)
+        if executor is not None:
+            pages = self.prefetch_pages(pages, executor)
+        self.profiler = profiler
+        self.ticket.profiler = profiler
+        try:
+            for page, cells in pages:
+                self.paint_page(canvas, cells, cropmarks=cropmarks, page=page)
+        finally:
+            self.profiler = None
+            self.ticket.profiler = None
+        if profiler is not None:
+            profiler.finish()
+
+    def write_index(self, filename, order=STACKORDER, invert=False, pages_per_file=None):
+        """
+        Write a JobIndex file recording the page, column, row, label
+        offset and output file of every ticket number. The placements
+        are computed from the numbers, nothing is laid out or drawn.
+
+        Parameters
+        ----------
+
+        pages_per_file: int
+            Number of pages per output file as used by generate_files.
+            The index of the file is stored as shard. By default all
+            pages are in one file.
+        """
+        if pages_per_file is None:
+            pages_per_file = self.numpages
+        record = JobIndex.record
+        chunksize = 4096
+        with open(filename, "wb") as f:
+            f.write(JobIndex.header.pack(JobIndex.magic, JobIndex.version, record.size,
+                                         self.numoffset, self.numtickets))
+            for start in range(0, self.numtickets, chunksize):
+                end = min(start + chunksize, self.numtickets)
+                buf = bytearray(record.size * (end - start))
+                for i in range(start, end):
+                    page, slot = self.slot_of(self.numoffset + i, order, invert)
+                    col, row = self.cells[slot]
+                    record.pack_into(buf, (i - start) * record.size, page, col, row,
+                                     self.label_offset(page, slot, order, invert),
+                                     page // pages_per_file)
+                f.write(buf)
+
+    def reprint(self, canvas, numbers, order=STACKORDER, cropmarks=True, invert=False, compact=False):
+        """
+        Paint again the tickets with the given numbers, e.g. after a
+        paper jam, without laying out the rest of the job. order and
+        invert must be the ones of the original run. The labels are
+        looked up with get_labels_at, so a list of labels must not
+        have been used up by a previous generate.
+
+        Parameters
+        ----------
+
+        numbers: iterable
+            Numbers of the tickets to reprint.
+
+        compact: Boolean
+            If False, every page holding one of the tickets is painted
+            again as a whole, so it can replace the original sheet.
+            If True, only the given tickets are painted, filling the
+            cells of as few pages as possible in ascending order.
+
+        Returns the sorted list of the affected pages of the original
+        document.
+        """
+        slots = {number: self.slot_of(number, order, invert) for number in set(numbers)}
+        pages = sorted(set(page for page, slot in slots.values()))
+        if compact is True:
+            offsets = {number: self.label_offset(page, slot, order, invert)
+                       for number, (page, slot) in slots.items()}
+            labels = self.get_labels_at(offsets.values())
+            tickets = [(number, labels[offsets[number]]) for number in sorted(slots)]
+            for start in range(0, len(tickets), self.tickets_per_page):
+                cells = []
+                for slot, (number, label) in enumerate(tickets[start:start+self.tickets_per_page]):
+                    col, row = self.cells[slot]
+                    cells.append((col, row, number, label))
+                self.paint_page(canvas, cells, cropmarks=cropmarks)
+        else:
+            layouts = []
+            for page in pages:
+                layouts.append((page, self.get_page_numbers(page, order, invert)))
+            labels = self.get_labels_at(self.label_offset(page, slot, order, invert)
+                                        for page, numbers in layouts
+                                        for slot in range(0, len(numbers)))
+            for page, numbers in layouts:
+                cells = []
+                for slot, number in enumerate(numbers):
+                    col, row = self.cells[slot]
+                    cells.append((col, row, number, labels[self.label_offset(page, slot, order, invert)]))
+                self.paint_page(canvas, cells, cropmarks=cropmarks, page=page)
+        return pages
+
+    def paint_page(self, canvas, cells, cropmarks=True, page=None):
+        """
+        Paint one page of tickets and finish the page.
+        cells is a list of (col, row, number, label) tuples
+        as yielded by iter_pages. They fill the cells in order
+        starting with the first one, the origins are taken from
+        the precomputed origins list.
+        """
+        if self.profiler is not None:
+            self.profile_page(canvas, cells, cropmarks, page)
+            return
+        if cropmarks is True:
+            self.paint_cropmarks(canvas)
+        self.ticket.begin_batch()
+        for (x, y), rotated, (col, row, number, label) in zip(self.origins, self.rotations, cells):
+            self.ticket.set_number(number)
+            self.ticket.set_label(label)
+            self.ticket.set_origin(x, y)
+            if rotated is True:
+                self.ticket.paint_rotated(canvas)
+            else:
+                self.ticket.paint(canvas)
+        self.ticket.end_batch(canvas)
+        canvas.showPage()
+
+    def profile_page(self, canvas, cells, cropmarks, page):
         """
-        self.generate_numbers(order=order, invert=invert)
-        for numbers in self.numbers:
-            col = 0
-            row = 0
-            if cropmarks is True:
-                self.paint_cropmarks(canvas)
-            for number in numbers:
-                self.ticket.set_number(number)
-                self.ticket.set_label(self.get_label())
-                x,y = self.get_cell(col, row)
-                self.ticket.set_origin(x, y)
+        Same as paint_page but records the timings of the page
+        in the profiler.
+        """
+        profiler = self.profiler
+        cropmarktime = 0.0
+        if cropmarks is True:
+            cropmarktime = profiler.call(("page", "paint_cropmarks"), canvas, self.paint_cropmarks, canvas)
+        t0 = perf_counter()
+        self.ticket.begin_batch()
+        for (x, y), rotated, (col, row, number, label) in zip(self.origins, self.rotations, cells):
+            self.ticket.set_number(number)
+            self.ticket.set_label(label)
+            self.ticket.set_origin(x, y)
+            if rotated is True:
+                self.ticket.paint_rotated(canvas)
+            else:
                 self.ticket.paint(canvas)
-                if col < self.colcount - 1:
-                    col += 1
+        tickettime = perf_counter() - t0
+        profiler.add(("page", "tickets"), tickettime)
+        profiler.call(("page", "text batch"), canvas, self.ticket.end_batch, canvas)
+        showpagetime = profiler.call(("page", "showPage"), canvas, canvas.showPage)
+        profiler.add_page(page, cropmarktime, tickettime, showpagetime)
+
+    def get_pages_per_file(self, max_pages=None, max_tickets=None):
+        """
+        Number of pages per output file for a sharding policy.
+        """
+        pages = self.numpages
+        if max_pages is not None:
+            pages = min(pages, max_pages)
+        if max_tickets is not None:
+            pages = min(pages, max(1, max_tickets // self.tickets_per_page))
+        return max(1, pages)
+
+    def generate_files(self, filename, order=STACKORDER, cropmarks=True, invert=False,
+                       max_pages=None, max_tickets=None, manifest=None, canvasclass=Canvas,
+                       executor=None, checkpoint=None, resume=False, index=None):
+        """
+        Same as generate but the pages are written to several PDF
+        files, each of which can be opened and printed on its own.
+        Numbers are assigned for the whole job, so with STACKORDER
+        the piles of all files together are in order.
+
+        Parameters
+        ----------
+
+        filename: str
+            Template of the file names, formatted with the index of
+            the file, e.g. "tickets_{0:03d}.pdf".
+
+        max_pages: int
+            Maximum number of pages per file.
+
+        max_tickets: int
+            Maximum number of tickets per file. Files always hold
+            whole pages, at least one.
+
+        manifest: str
+            Name of a JSON file recording the pages and the ranges
+            of ticket numbers in every file.
+
+        canvasclass: class
+            Canvas class used for the files, e.g. StreamingCanvas.
+
+        checkpoint: str
+            Name of a JSON file where the progress is recorded every
+            time a file is complete: the next page, the number of
+            labels used, the seed and the files written so far.
+            A job is resumed with the first file that is not complete,
+            so max_pages or max_tickets must be given to split the job
+            into files small enough to be redone.
+
+        resume: Boolean
+            Continue the job recorded in checkpoint with the next
+            page, writing to the next file. The layout must have been
+            set up the same way, including the labels.
+
+        index: str
+            Optional name of a JobIndex file recording where every
+            ticket number is printed. The shard of a placement is the
+            index of its file.
+
+        Returns the list of file names.
+        """
+        if checkpoint is not None and max_pages is None and max_tickets is None:
+            raise ValueError("a checkpoint requires max_pages or max_tickets")
+        pages_per_file = self.get_pages_per_file(max_pages, max_tickets)
+        state = {"numtickets": self.numtickets, "numoffset": self.numoffset,
+                 "tickets_per_page": self.tickets_per_page, "pages_per_file": pages_per_file,
+                 "order": order, "invert": invert, "seed": self.seed,
+                 "next_page": 0, "labels_used": 0, "files": []}
+        if resume is True and checkpoint is not None and os.path.exists(checkpoint):
+            state = self.load_checkpoint(checkpoint, state)
+        files = state["files"]
+        keep_numbers = manifest is not None or checkpoint is not None
+        for i in range(0, state["labels_used"]):
+            self.get_label()
+        if index is not None:
+            self.write_index(index, order=order, invert=invert, pages_per_file=pages_per_file)
+        pages = self.iter_pages(order=order, invert=invert, start=state["next_page"])
+        if executor is not None:
+            pages = self.prefetch_pages(pages, executor)
+        canvas = None
+        for page, cells in pages:
+            if canvas is None:
+                current = {"filename": filename.format(len(files)),
+                           "pages": [page, page], "tickets": 0}
+                numbers = []
+                canvas = canvasclass(current["filename"], pagesize=self.pagesize)
+            self.paint_page(canvas, cells, cropmarks=cropmarks, page=page)
+            current["pages"][1] = page
+            current["tickets"] += len(cells)
+            if keep_numbers:
+                numbers.extend(cell[2] for cell in cells)
+            if (page + 1) % pages_per_file == 0 or page == self.numpages - 1:
+                canvas.save()
+                canvas = None
+                if keep_numbers:
+                    current["numbers"] = to_ranges(numbers)
+                files.append(current)
+                state["next_page"] = page + 1
+                state["labels_used"] += current["tickets"]
+                if checkpoint is not None:
+                    self.save_checkpoint(checkpoint, state)
+        if manifest is not None:
+            with open(manifest, "w") as f:
+                json.dump({"numtickets": self.numtickets, "numoffset": self.numoffset,
+                           "order": order, "invert": invert, "seed": self.seed,
+                           "files": files}, f, indent=1)
+        return [f["filename"] for f in files]
+
+    def save_checkpoint(self, filename, state):
+        """
+        Write the checkpoint atomically, so that a crash never
+        leaves a half written file behind.
+        """
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmpname, filename)
+
+    def load_checkpoint(self, filename, state):
+        """
+        Read a checkpoint and check that it belongs to a job with the
+        same layout as described by state. The seed of the layout is
+        set to the one of the checkpoint.
+        """
+        with open(filename) as f:
+            saved = json.load(f)
+        for key in ("numtickets", "numoffset", "tickets_per_page", "pages_per_file", "order", "invert"):
+            if saved[key] != state[key]:
+                raise ValueError("checkpoint {0} does not match the layout: {1} is {2}, not {3}".format(
+                    filename, key, saved[key], state[key]))
+        self.seed = saved["seed"]
+        return saved
+
+    def get_worker_layout(self):
+        """
+        Copy of the layout that can be sent to a worker process. It
+        holds neither numbers nor labels, which are assigned in the
+        parent process, nor references to a canvas.
+        """
+        worker_layout = copy.copy(self)
+        worker_layout.numbers = []
+        worker_layout.labels = []
+        worker_layout.labeliter = None
+        worker_layout.cropmarkcanvas = None
+        worker_layout.ticket = copy.copy(self.ticket)
+        worker_layout.ticket.formcanvas = None
+        return worker_layout
+
+    def generate_parallel(self, filename, order=STACKORDER, cropmarks=True, invert=False,
+                          processes=None, pages_per_shard=None, index=None):
+        """
+        Same as generate but the pages are rendered by several
+        worker processes, each of them into a PDF file of its own.
+        The files are merged into filename in page order afterwards.
+        Numbers and labels are assigned in the parent process so the
+        result is the same as with generate. Requires pypdf.
+
+        Parameters
+        ----------
+
+        filename: str
+            Name of the PDF file to write.
+
+        processes: int
+            Number of worker processes, defaults to the number of CPUs.
+
+        pages_per_shard: int
+            Number of pages rendered by a worker at once. By default the
+            pages are split into four shards per worker process.
+
+        index: str
+            Optional name of a JobIndex file, see write_index.
+        """
+        from pypdf import PdfWriter
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if pages_per_shard is None:
+            pages_per_shard = max(1, ceil(self.numpages / (processes * 4)))
+        if index is not None:
+            self.write_index(index, order=order, invert=invert)
+        worker_layout = self.get_worker_layout()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shardnames = []
+            futures = []
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                pages = []
+                for page in self.iter_pages(order=order, invert=invert):
+                    pages.append(page)
+                    if len(pages) == pages_per_shard or page[0] == self.numpages - 1:
+                        shardname = os.path.join(tmpdir, "shard{0:06d}.pdf".format(len(shardnames)))
+                        shardnames.append(shardname)
+                        futures.append(executor.submit(render_shard, worker_layout, shardname,
+                                                       pages, cropmarks))
+                        pages = []
+            for future in futures:
+                future.result()
+            writer = PdfWriter()
+            for shardname in shardnames:
+                writer.append(shardname)
+            writer.compress_identical_objects()
+            with open(filename, "wb") as f:
+                writer.write(f)
+
+
+    def generate_images(self, filename, order=STACKORDER, cropmarks=True, invert=False,
+                        dpi=300, mode="RGB", compression=None, processes=None):
+        """
+        Render every page to a raster image file. The pages are
+        rendered by worker processes, one page per task, and every
+        image is written as soon as its page is done. Numbers and
+        labels are assigned in the parent process so the result is
+        the same as with generate. Requires PyMuPDF and Pillow.
+
+        Parameters
+        ----------
+
+        filename: str
+            Template of the file names, formatted with the index of
+            the page, e.g. "sheet_{0:04d}.png". The extension selects
+            the image format, e.g. PNG or TIFF.
+
+        dpi: int
+            Resolution of the images.
+
+        mode: str
+            Pillow colour mode of the images, e.g. "RGB", "L" for
+            grayscale, "1" for black and white or "CMYK".
+
+        compression: int or str
+            For PNG the zlib compression level from 0 to 9, for TIFF
+            the Pillow compression name such as "tiff_lzw",
+            "tiff_deflate" or "group4". By default Pillow decides.
+
+        processes: int
+            Number of worker processes, defaults to the number of CPUs.
+
+        Returns the list of file names.
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+        worker_layout = self.get_worker_layout()
+        filenames = []
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = deque()
+            for page, cells in self.iter_pages(order=order, invert=invert):
+                filenames.append(filename.format(page))
+                futures.append(executor.submit(render_image, worker_layout, filenames[-1], page,
+                                               cells, cropmarks, dpi, mode, compression))
+                if len(futures) > 2 * processes:
+                    futures.popleft().result()
+            while len(futures) > 0:
+                futures.popleft().result()
+        return filenames
+
+
+    def export_tickets(self, target, filename="ticket_{0:05d}.png", dpi=300, mode="RGB",
+                       processes=None, chunksize=256):
+        """
+        Export every ticket on its own, as an image or a single page
+        PDF file, e.g. for digital delivery. The tickets are numbered
+        in ascending order and take the labels in turn. The work is
+        spread over worker processes in chunks of tickets and the
+        files are written as soon as their chunk is done.
+
+        For images the static background of the ticket is rendered
+        only once and the remaining layers of every ticket are
+        composited on top of it. PDF files embed the background as a
+        form, decoded artwork being shared through the caches.
+        Requires PyMuPDF and Pillow for images.
+
+        Parameters
+        ----------
+
+        target: str or file
+            Directory the files are written to. A file name ending
+            in ".zip" or a writable binary file object receives a
+            zip archive of the files instead.
+
+        filename: str
+            Template of the file names, formatted with the ticket
+            number. The extension selects the format, ".pdf" for PDF
+            files, anything else for images saved with Pillow.
+
+        dpi: int
+            Resolution of the images.
+
+        mode: str
+            Pillow colour mode of the images, e.g. "RGB" or "L".
+
+        processes: int
+            Number of worker processes, defaults to the number of CPUs.
+
+        chunksize: int
+            Number of tickets rendered by a worker at once.
+
+        Returns the list of file names.
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+        ticket = copy.copy(self.ticket)
+        ticket.formcanvas = None
+        ticket.profiler = None
+        ticket.textbatch = None
+        background = None
+        if not filename.lower().endswith(".pdf"):
+            background = render_background(ticket, dpi)
+        if isinstance(target, str) and not target.lower().endswith(".zip"):
+            os.makedirs(target, exist_ok=True)
+            archive = None
+        else:
+            archive = zipfile.ZipFile(target, "w")
+        names = []
+
+        def write(files):
+            for name, data in files:
+                if archive is None:
+                    with open(os.path.join(target, name), "wb") as f:
+                        f.write(data)
                 else:
-                    col = 0
-                    row +=1
-            canvas.showPage()
-                    
-                    
-        
-        
-        
+                    archive.writestr(name, data)
+                names.append(name)
+
+        try:
+            with ProcessPoolExecutor(max_workers=processes, initializer=init_export,
+                                     initargs=(ticket, background, dpi, mode)) as executor:
+                futures = deque()
+                for start in range(0, self.numtickets, chunksize):
+                    tickets = [(number, self.get_label()) for number in
+                               range(self.numoffset + start,
+                                     self.numoffset + min(start + chunksize, self.numtickets))]
+                    futures.append(executor.submit(export_chunk, tickets, filename))
+                    if len(futures) > 2 * processes:
+                        write(futures.popleft().result())
+                while len(futures) > 0:
+                    write(futures.popleft().result())
+        finally:
+            if archive is not None:
+                archive.close()
+        return names
+
+
+class JobIndex(object):
+    """
+    Read only view of an index file written by PageLayout.write_index.
+    The file is memory mapped and holds one fixed size record per
+    ticket number, so a lookup is a single offset computation and
+    the file is never loaded as a whole.
+
+    Attributes
+    ----------
+
+    numoffset: int
+        First ticket number of the job.
+
+    numtickets: int
+        Number of tickets of the job.
+    """
+    magic = b"ETIX"
+    version = 1
+    header = struct.Struct("<4sHHqq")
+    record = struct.Struct("<IHHQI")
+
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError("{0} is not an index file".format(filename))
+        if len(self.map) < self.header.size:
+            self.close()
+            raise ValueError("{0} is not an index file".format(filename))
+        magic, version, recordsize, self.numoffset, self.numtickets = self.header.unpack_from(self.map)
+        if magic != self.magic or version != self.version or recordsize != self.record.size:
+            self.close()
+            raise ValueError("{0} is not an index file of version {1}".format(filename, self.version))
+
+    def __len__(self):
+        return self.numtickets
+
+    def __contains__(self, number):
+        return 0 <= number - self.numoffset < self.numtickets
+
+    def __getitem__(self, number):
+        return self.lookup(number)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def lookup(self, number):
+        """
+        Placement (page, col, row, label, shard) of a ticket number,
+        where label is the offset of its label in the label list.
+        """
+        if number not in self:
+            raise KeyError(number)
+        offset = self.header.size + (number - self.numoffset) * self.record.size
+        return Placement(*self.record.unpack_from(self.map, offset))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def to_ranges(numbers):
+    """
+    Compress a list of integers to a sorted list of
+    [first, last] ranges.
+    """
+    ranges = []
+    for number in sorted(numbers):
+        if len(ranges) > 0 and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ranges
+
+
+def render_shard(layout, filename, pages, cropmarks=True):
+    """
+    Render a list of pages as yielded by PageLayout.iter_pages
+    into a PDF file. Used by the worker processes of
+    PageLayout.generate_parallel.
+    """
+    canvas = Canvas(filename, pagesize=layout.pagesize)
+    for page, cells in pages:
+        layout.paint_page(canvas, cells, cropmarks=cropmarks)
+    canvas.save()
+
+
+def render_image(layout, filename, page, cells, cropmarks=True, dpi=300, mode="RGB",
+                 compression=None):
+    """
+    Render a page as yielded by PageLayout.iter_pages into a raster
+    image file. The page is painted into a PDF in memory which is
+    rasterised with PyMuPDF and saved with Pillow. Used by the worker
+    processes of PageLayout.generate_images.
+    """
+    import pymupdf
+    from PIL import Image
+    buf = io.BytesIO()
+    canvas = Canvas(buf, pagesize=layout.pagesize)
+    layout.paint_page(canvas, cells, cropmarks=cropmarks, page=page)
+    canvas.save()
+    if mode in ("L", "1"):
+        colorspace, rawmode = pymupdf.csGRAY, "L"
+    else:
+        colorspace, rawmode = pymupdf.csRGB, "RGB"
+    with pymupdf.open("pdf", buf.getvalue()) as doc:
+        pix = doc[0].get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+        image = Image.frombytes(rawmode, (pix.width, pix.height), pix.samples)
+    if image.mode != mode:
+        image = image.convert(mode)
+    options = {}
+    if compression is not None:
+        if os.path.splitext(filename)[1].lower() == ".png":
+            options["compress_level"] = compression
+        else:
+            options["compression"] = compression
+    image.save(filename, dpi=(dpi, dpi), **options)
+
+
+export_state = {}
+
+
+def render_background(ticket, dpi):
+    """
+    Rasterise the static background of a ticket on white paper.
+    Returns a Pillow image in RGBA mode.
+    """
+    import pymupdf
+    from PIL import Image
+    buf = io.BytesIO()
+    canvas = Canvas(buf, pagesize=(ticket.width, ticket.height))
+    ticket.set_origin(0, 0)
+    ticket.paint_background(canvas)
+    canvas.save()
+    ticket.formcanvas = None
+    with pymupdf.open("pdf", buf.getvalue()) as doc:
+        pix = doc[0].get_pixmap(dpi=dpi, alpha=False)
+        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    return image.convert("RGBA")
+
+
+def init_export(ticket, background, dpi, mode):
+    """
+    Initialise a worker process of PageLayout.export_tickets.
+    """
+    export_state["ticket"] = ticket
+    export_state["background"] = background
+    export_state["dpi"] = dpi
+    export_state["mode"] = mode
+
+
+def export_chunk(tickets, filename):
+    """
+    Render a list of (number, label) tuples in a worker process of
+    PageLayout.export_tickets. Returns a list of (name, data) tuples.
+    """
+    ticket = export_state["ticket"]
+    ticket.set_origin(0, 0)
+    files = []
+    if export_state["background"] is None:
+        for number, label in tickets:
+            buf = io.BytesIO()
+            canvas = Canvas(buf, pagesize=(ticket.width, ticket.height))
+            ticket.set_number(number)
+            ticket.set_label(label)
+            ticket.paint(canvas)
+            canvas.save()
+            files.append((filename.format(number), buf.getvalue()))
+        return files
+    import pymupdf
+    from PIL import Image
+    buf = io.BytesIO()
+    canvas = Canvas(buf, pagesize=(ticket.width, ticket.height))
+    for number, label in tickets:
+        ticket.set_number(number)
+        ticket.set_label(label)
+        ticket.paint(canvas, background=False)
+        canvas.showPage()
+    canvas.save()
+    background = export_state["background"]
+    fmt = Image.registered_extensions().get(os.path.splitext(filename)[1].lower())
+    with pymupdf.open("pdf", buf.getvalue()) as doc:
+        for (number, label), page in zip(tickets, doc):
+            pix = page.get_pixmap(dpi=export_state["dpi"], alpha=True)
+            # the colours of the pixmap are premultiplied with alpha
+            layer = Image.frombytes("RGBa", (pix.width, pix.height), pix.samples).convert("RGBA")
+            image = Image.alpha_composite(background, layer).convert(export_state["mode"])
+            out = io.BytesIO()
+            image.save(out, format=fmt, dpi=(export_state["dpi"], export_state["dpi"]))
+            files.append((filename.format(number), out.getvalue()))
+    return files